@@ -1,5 +1,17 @@
-from flask import Flask, jsonify, render_template
+import sqlite3
+
+from flask import Flask, Response, jsonify, render_template
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, event, func, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.hybrid import hybrid_property
+
+# orjson turns big lists into JSON much faster than flask's built in jsonify, but it's optional - the app works fine
+# without it (we just fall back to jsonify), so if you want the speed up install it yourself with: pip install orjson
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Create our flask app
 app = Flask(__name__)
@@ -17,10 +29,54 @@ app.config['SQLALCHEMY_BINDS'] = {'input_database': 'sqlite:///input_database.sq
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Here we create the database object, which is slightly confusing as it's not a single database in this situation - it's a connection to both our databases
-db = SQLAlchemy(app)
+# We also switch off two bits of session bookkeeping we don't use: expiring every loaded object after a commit (so it
+# would have to be reloaded next time it's touched) and automatically flushing pending changes before each query
+db = SQLAlchemy(app, session_options={'expire_on_commit': False, 'autoflush': False})
 db.init_app(app)
 
 
+# Each time a new sqlite connection is opened we let sqlite keep its temporary tables in memory and give it a bigger
+# cache (64MB, sqlite wants this as a negative number of kilobytes) so it goes to disk less often
+# Listening on Engine (rather than one particular engine) means this runs for both our input and output databases
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.close()
+
+
+# By default sqlite waits for every commit to be physically written to disk before carrying on, which makes writing
+# lots of data slow. For the output database we switch to write-ahead logging (WAL), which only needs to sync to disk
+# occasionally and lets people read the database while it's being written to
+# We only do this for the output database, as the WAL setting is saved inside the database file itself - doing it to
+# the input database (which is checked in to git) would change the file just by reading from it
+@event.listens_for(db.engine, "connect")
+def set_output_database_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+# Turn a list or dictionary into a JSON response, using orjson if we have it
+# We follow flask's own JSON settings (app.json) for whether to sort the keys and whether to spread things out over
+# several lines (which flask does in debug mode), so you get the same JSON whether or not orjson is installed
+# Note it's the same JSON rather than exactly the same text - e.g. jsonify writes an é as \u00e9, orjson just writes é
+def json_response(data):
+    if orjson is None:
+        return jsonify(data)
+
+    options = orjson.OPT_APPEND_NEWLINE
+    if app.json.sort_keys:
+        options = options | orjson.OPT_SORT_KEYS
+    if (app.json.compact is None and app.debug) or app.json.compact is False:
+        options = options | orjson.OPT_INDENT_2
+    return Response(orjson.dumps(data, option=options), mimetype='application/json')
+
+
 # Define our models - this ensure that SQLAlchemy knows how to interface with them
 # Note that defining them here doesn't actually create them anywhere
 
@@ -28,7 +84,7 @@ class InputPerson(db.Model):
     __bind_key__ = 'input_database'  # We need this here to make clear that this is in our input database
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80))
-    nickname = db.Column(db.String(50))
+    nickname = db.Column(db.String(50), index=True)  # index=True lets the database find people by nickname (e.g. when counting the Fonzies in process_everything) without checking every row
     gender = db.Column(db.String(6))
     age = db.Column(db.Integer)
 
@@ -43,9 +99,32 @@ class OutputPerson(db.Model):
     is_cool = db.Column(db.Boolean)
 
     # This is a cool way of performing functions on data without actually having it saved to the database - it is calculated each time it's called
-    @property
+    # partition() stops at the first space, rather than split() which would chop up the whole name just to give us the first bit
+    @hybrid_property
     def first_name(self):
-        return str.split(self.name)[0]
+        return self.name.partition(" ")[0]
+
+    # Because it's a @hybrid_property we can also tell SQLAlchemy how to work out the first name in SQL, which means
+    # we can ask the database for it directly in a query, e.g. select(OutputPerson.first_name)
+    @first_name.expression
+    def first_name(cls):
+        position_of_space = func.instr(cls.name, " ")
+        return case(
+            (position_of_space > 0, func.substr(cls.name, 1, position_of_space - 1)),
+            else_=cls.name
+        )
+
+
+# The statements our routes use to write data are the same every time, so we build them once here rather than on
+# every request. SQLAlchemy also remembers the SQL it generates for each one, so it doesn't have to work it out again
+insert_input_people = InputPerson.__table__.insert()
+delete_output_people = OutputPerson.__table__.delete()
+copy_input_people_to_output = text(
+    "INSERT INTO output_person (name, nickname, gender, age, is_cool) "
+    "SELECT name, nickname, gender, age, CASE WHEN nickname = 'Fonzie' THEN 1 ELSE 0 END "
+    "FROM input_db.input_person"
+)
+count_cool_input_people = text("SELECT COUNT(*) FROM input_db.input_person WHERE nickname = 'Fonzie'")
 
 
 # This route creates the input database - it's included here just so you know how it works
@@ -86,7 +165,6 @@ def create_input_database():
         gender="female",
         age=20
     ))
-    db.session.add(new_person)
 
     # Write everything to the database
     # If you don't do this nothing will happen
@@ -99,7 +177,13 @@ def create_input_database():
 def show_input_database():
 
     # Get all the records from the table
-    list_of_people = InputPerson.query.all()
+    # Rather than loading whole InputPerson objects we just ask for the columns we want, which gives us each row back
+    # as a simple tuple of values
+    # yield_per() fetches the rows from the database 1,000 at a time rather than all at once
+    list_of_people = db.session.execute(
+        select(InputPerson.id, InputPerson.name, InputPerson.nickname, InputPerson.gender, InputPerson.age)
+        .execution_options(yield_per=1000)
+    )
 
     # Other things you could do would be:
     # list_of_male_people = InputPerson.query.filter_by(gender="male).all()
@@ -112,117 +196,127 @@ def show_input_database():
     # filter() allows you to do standard python comparisons such as ==, >, < etc
     # In filter_by you don't need to specify the table name, in filter you do
 
-    # We want to output a list of dictionaries via json, which means we need an empty list to start with
-    output_list = []
-
-    # Iterate through each result from the DB query, put the data from the query into a dictionary and then append that
-    # dictionary to the output list
-    for person in list_of_people:
-        output_person = {
-            'id': person.id,
-            'name': person.name,
-            'nickname': person.nickname,
-            'gender': person.gender,
-            'age': person.age,
-        }
-        output_list.append(output_person)
+    # Turn each row into a dictionary so it can be output via json, by pairing up the column names with the values
+    # in the row - zip() does this much more quickly than looking each column up by name
+    column_names = tuple(list_of_people.keys())
+    output_list = [dict(zip(column_names, person)) for person in list_of_people]
 
     # Return the output list in easy to read JSON
-    return jsonify(output_list)
+    return json_response(output_list)
 
 
 @app.route('/show_output_database')
 def show_output_database():
 
+    # As in show_input_database we just ask for the columns we want and turn each row into a dictionary
     try:
-        list_of_people = OutputPerson.query.all()
+        list_of_people = db.session.execute(
+            select(
+                OutputPerson.id, OutputPerson.name, OutputPerson.nickname, OutputPerson.gender, OutputPerson.age, OutputPerson.is_cool,
+                OutputPerson.first_name.label('first_name')  #Note that this hasn't actually been stored, the database works it out for us using the @hybrid_property in the class
+            )
+            .execution_options(yield_per=1000)
+        )
+
+        column_names = tuple(list_of_people.keys())
+        output_list = [dict(zip(column_names, person)) for person in list_of_people]
     except:
         return jsonify (
             {'status': 'error',
              'what_happened': 'Could not access output database. Did you create it already?'}
         )
 
-    # We want to output a list of dictionaries via json, which means we need an empty list to start with
-    output_list = []
-
-    # Iterate through each result from the DB query, put the data from the query into a dictionary and then append that dictionary to the output list
-    for person in list_of_people:
-        output_person = {
-            'id': person.id,
-            'name': person.name,
-            'nickname': person.nickname,
-            'gender': person.gender,
-            'age': person.age,
-            'is_cool': person.is_cool,
-            'first_name': person.first_name  #Note that this hasn't actually been stored, it's just generated automatically by the @property decorator in the class
-        }
-        output_list.append(output_person)
-
     # Return the output list in easy to read JSON
-    return jsonify(output_list)
+    return json_response(output_list)
 
 
 @app.route('/process_everything')
 def process_everything():
 
-    # We want to clear everything in our output database and then recreate it
-    # By specifying bind=None here we make clear that it should be the default database which is dropped and created
-    # If you were to just specify drop_all() and create_all() this would wipe all databases
-    db.drop_all(bind=None)
-    db.create_all(bind=None)
-
-    # Query the input database to get all people and put it into a list
-    list_of_input_people = InputPerson.query.all()
-
-    number_of_people_processed = 0
-    number_of_cool_people_processed = 0
-    for input_person in list_of_input_people:
-
-        # Do the processing
-        if input_person.nickname == "Fonzie":
-            is_this_person_cool = True
-            number_of_cool_people_processed = number_of_cool_people_processed + 1
-        else:
-            is_this_person_cool = False
-
-        # Create the new record
-        new_output_person = OutputPerson (
-            name=input_person.name,
-            nickname=input_person.nickname,
-            gender=input_person.gender,
-            age=input_person.age,
-            is_cool=is_this_person_cool
-        )
-
-        # Write the record in the output database
-        db.session.add(new_output_person)
-
-        number_of_people_processed = number_of_people_processed + 1
-
-    db.session.commit()
+    # Rather than reading every person into python and writing them back out again, we can get the database to do the
+    # whole thing in one statement. Our two tables live in separate sqlite files, so first we "attach" the input
+    # database to a connection to the output database, which lets one query see both of them
+    # Note that this only works because both databases are sqlite files - with mysql or postgres you would do
+    # something similar with a schema or a foreign table
+    # If your databases can't see each other at all you would have to read the people into python and write them back
+    # out. If so, don't add an OutputPerson object for each one - build a list of dictionaries and write them in one go:
+    # list_of_output_people = [{'name': ..., 'is_cool': ...} for input_person in ...]
+    # db.session.execute(OutputPerson.__table__.insert(), list_of_output_people)
+    # (older code does the same thing with db.session.bulk_insert_mappings(OutputPerson, list_of_output_people))
+    input_database_path = db.get_engine(bind='input_database').url.database
+
+    with db.engine.connect() as connection:
+        # We want to clear everything out of our output table before we start
+        # Dropping and recreating the whole database each time is surprisingly slow, so instead we just make sure the
+        # table exists (checkfirst=True means it is only created the first time) and then delete everything in it below
+        OutputPerson.__table__.create(bind=connection, checkfirst=True)
+        connection.execute(text("ATTACH DATABASE :path AS input_db"), {'path': input_database_path})
+
+        try:
+            with connection.begin():
+                # Empty the output table, ready for the new records
+                connection.execute(delete_output_people)
+
+                # Do the processing and write the records in the output database, all in one go
+                result = connection.execute(copy_input_people_to_output)
+                number_of_people_processed = result.rowcount
+
+                # Count the cool people straight from the input table - the index on nickname means the database can
+                # jump straight to the Fonzies rather than checking every row
+                number_of_cool_people_processed = connection.execute(count_cool_input_people).scalar()
+        finally:
+            connection.execute(text("DETACH DATABASE input_db"))
 
     return (str(number_of_people_processed) + " people processed of which " + str(number_of_cool_people_processed) + " were cool")
 
 
 @app.route('/create_lots_of_people')
 def create_lots_of_people():
-    for a in range(1,100000):
-        db.session.add(InputPerson(
-          name="Someone else",
-          nickname="Too boring to have a nickname",
-          gender="Unclear",
-          age=25
-        ))
+    # Adding 100,000 InputPerson objects to the session one by one is very slow, as SQLAlchemy has to keep track of
+    # every one of them. Instead we hand a list of plain dictionaries to a single insert statement, which the database
+    # driver sends as one big batch
+    # Everyone is the same here, so the list can just hold the same dictionary over and over rather than building a
+    # new one for each person
+    new_person = {
+        'name': "Someone else",
+        'nickname': "Too boring to have a nickname",
+        'gender': "Unclear",
+        'age': 25
+    }
+    list_of_new_people = [new_person] * 99999
+
+    # We write straight to the input database's engine inside a single transaction, so everything is committed
+    # (and written to disk) once at the end rather than bit by bit
+    with db.get_engine(bind='input_database').begin() as connection:
+        connection.execute(insert_input_people, list_of_new_people)
 
-    db.session.commit()
     return "100,000 people created in input database"
 
 
 # Index route
+# The how to page never changes, so rather than rendering the template every time someone visits we render it once
+# (the first time it's asked for, as url_for() needs a request to work) and then keep sending back the same page
+# The exception is when flask is reloading templates as you edit them (which it does in debug mode) - then we render
+# it fresh every time so your changes show up
+howto_page = None
+
+
 @app.route('/')
 def index_route():
-    return render_template('howto.html')
+    if app.jinja_env.auto_reload:
+        return render_template('howto.html')
+
+    global howto_page
+    if howto_page is None:
+        howto_page = render_template('howto.html').encode()
+
+    response = Response(howto_page, mimetype='text/html')
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response
 
 # Main loop
+# This runs flask's built in development server, which is handy while you're playing around but slow - see wsgi.py
+# for how to run it properly
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=12345, debug=True)
@@ -0,0 +1,5 @@
+# Entry point for running the app under a production WSGI server such as gunicorn or waitress, e.g.
+#   gunicorn -k gthread -w 2 --threads 8 wsgi:application
+#   waitress-serve --threads=8 wsgi:application
+# Unlike flask's built in server this lets lots of requests be handled at the same time and doesn't run the debugger
+from app import app as application